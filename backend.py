@@ -1,26 +1,86 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect as sa_inspect, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
 from datetime import datetime, timedelta
 import base64
+import hashlib
+import io
 import os
-import json
-from typing import Dict, List, Optional
+import queue
+import re
+import sqlite3
+import threading
+import time
+from typing import ClassVar, Dict, List, Optional
+import ciso8601
+import orjson
+from cachetools import TTLCache
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; images are then sent as uploaded
+    Image = ImageOps = None
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype='application/json',
+        )
+
 
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coupons.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///coupons.db')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 20, 'pool_pre_ping': True}
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET', 'your-secret-key-change-in-production')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=30)
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_ALGORITHM_STREAMING'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_BR_LEVEL'] = 4
 
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
+Compress(app)
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Use WAL so concurrent workers don't serialize on every commit"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
 
 
 # ============= DATABASE MODELS =============
@@ -56,20 +116,34 @@ class Coupon(db.Model):
     notified = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     image_path = db.Column(db.String(512))
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')
+
+    __table_args__ = (
+        db.Index('ix_coupon_user_expiry', 'user_id', 'expiry_date'),
+        db.Index('ix_coupon_user_claimed', 'user_id', 'claimed'),
+    )
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'code': self.code,
-            'title': self.title,
-            'provider': self.provider,
-            'discount': self.discount,
-            'terms': self.terms,
-            'expiryDate': self.expiry_date.isoformat(),
-            'deadline': self.deadline.isoformat() if self.deadline else None,
-            'claimed': self.claimed,
-            'scannedAt': self.created_at.isoformat(),
-        }
+        # Datetimes are left for orjson to format in C; its output matches isoformat()
+        return {key: getattr(self, column.key) for key, column in COUPON_FIELDS}
+
+
+# API key and column for each field of a serialized coupon, shared by
+# Coupon.to_dict and the row-level select in get_coupons
+COUPON_FIELDS = (
+    ('id', Coupon.id),
+    ('code', Coupon.code),
+    ('title', Coupon.title),
+    ('provider', Coupon.provider),
+    ('discount', Coupon.discount),
+    ('terms', Coupon.terms),
+    ('expiryDate', Coupon.expiry_date),
+    ('deadline', Coupon.deadline),
+    ('claimed', Coupon.claimed),
+    ('scannedAt', Coupon.created_at),
+    ('status', Coupon.status),
+)
+COUPON_KEYS = tuple(key for key, _ in COUPON_FIELDS)
 
 
 class UserSettings(db.Model):
@@ -91,13 +165,21 @@ class UserSettings(db.Model):
         }
 
 
+class OCRCache(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    provider = db.Column(db.String(50), nullable=False)
+    model = db.Column(db.String(50))
+    json_payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 # ============= OCR INTERFACE & IMPLEMENTATIONS =============
 
 class OCRProvider(ABC):
     """Abstract base class for OCR providers"""
 
     @abstractmethod
-    def extract_coupon_data(self, image_base64: str) -> Dict:
+    def extract_coupon_data(self, image_bytes: bytes) -> Dict:
         """
         Extract coupon data from image.
 
@@ -115,17 +197,35 @@ class OCRProvider(ABC):
         pass
 
 
+# Outermost {...} block, so fenced or prefixed model output still parses
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+
+def _build_session() -> requests.Session:
+    """Create a pooled HTTP session shared for the life of the worker"""
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=20))
+    return session
+
+
 class GPT4oOCR(OCRProvider):
     """GPT-4o Vision API OCR implementation"""
 
+    # Shared across instances so keep-alive connections to OpenAI are reused
+    _session: ClassVar[requests.Session] = _build_session()
+
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.model = "gpt-4o"
         self.base_url = "https://api.openai.com/v1"
+        # Enough for the seven-field schema; JSON mode stops trailing prose
+        self.max_tokens = 384
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
 
-    def extract_coupon_data(self, image_base64: str) -> Dict:
-        prompt = """Analyze this coupon image and extract the following information in JSON format:
-        {
+    _fields_prompt = """{
             "code": "the coupon/promo code",
             "title": "coupon title or description",
             "provider": "business or merchant name",
@@ -133,16 +233,53 @@ class GPT4oOCR(OCRProvider):
             "terms": "terms and conditions visible",
             "expiryDate": "ISO format date when coupon expires",
             "deadline": "ISO format deadline date if different from expiry"
+        }"""
+
+    @staticmethod
+    def _image_block(image_bytes: bytes) -> Dict:
+        # Encode once, straight into the data URL sent to the API
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode('ascii')
+            }
         }
 
+    def _build_payload(self, image_bytes: bytes) -> Dict:
+        prompt = f"""Analyze this coupon image and extract the following information in JSON format:
+        {self._fields_prompt}
+
         If a field is not visible or unclear, use null. Return only valid JSON."""
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+        return {
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        },
+                        self._image_block(image_bytes)
+                    ]
+                }
+            ],
+            "response_format": {"type": "json_object"},
+            "temperature": 0,
+            "max_tokens": self.max_tokens
         }
 
-        payload = {
+    def _build_batch_payload(self, images: List[bytes]) -> Dict:
+        prompt = f"""You are given {len(images)} coupon images. For each image, in the order given,
+        extract the following information:
+        {self._fields_prompt}
+
+        Respond with a JSON object of the form {{"coupons": [...]}} containing exactly one entry
+        per image, in the same order. If a field is not visible or unclear, use null.
+        Return only valid JSON."""
+
+        return {
             "model": self.model,
             "messages": [
                 {
@@ -152,52 +289,202 @@ class GPT4oOCR(OCRProvider):
                             "type": "text",
                             "text": prompt
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
+                        *(self._image_block(image) for image in images)
                     ]
                 }
             ],
-            "max_tokens": 1024
+            "response_format": {"type": "json_object"},
+            "temperature": 0,
+            "max_tokens": self.max_tokens * len(images)
         }
 
+    @staticmethod
+    def _convert_dates(coupon_data: Dict) -> Dict:
+        if coupon_data.get('expiryDate'):
+            coupon_data['expiryDate'] = ciso8601.parse_datetime(coupon_data['expiryDate'])
+        if coupon_data.get('deadline'):
+            coupon_data['deadline'] = ciso8601.parse_datetime(coupon_data['deadline'])
+        return coupon_data
+
+    @staticmethod
+    def _load_json(content: str) -> Dict:
+        match = _JSON_RE.search(content)
+        if not match:
+            raise ValueError("No JSON object in OCR response")
+        return orjson.loads(match.group(0))
+
+    def _parse_response(self, result: Dict) -> Dict:
+        content = result['choices'][0]['message']['content']
+
+        # Parse JSON from response
+        coupon_data = self._load_json(content)
+
+        # Convert date strings to datetime
+        return self._convert_dates(coupon_data)
+
+    def _parse_batch_response(self, result: Dict, count: int) -> List[Dict]:
+        content = result['choices'][0]['message']['content']
+        coupons = self._load_json(content)['coupons']
+
+        if len(coupons) != count:
+            raise ValueError(f"Expected {count} coupons in batch response, got {len(coupons)}")
+
+        return [self._convert_dates(coupon_data) for coupon_data in coupons]
+
+    def extract_coupon_batch(self, images: List[bytes]) -> List[Dict]:
+        """Extract coupon data from several images with a single API call"""
+        if len(images) == 1:
+            return [self._extract_one(images[0])]
+
+        payload = self._build_batch_payload(images)
+
         try:
-            response = requests.post(
+            response = self._session.post(
                 f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
+                headers=self.headers,
+                data=orjson.dumps(payload),
+                timeout=60
             )
             response.raise_for_status()
 
-            result = response.json()
-            content = result['choices'][0]['message']['content']
+            return self._parse_batch_response(orjson.loads(response.content), len(images))
+
+        except Exception as e:
+            print(f"GPT-4o batch OCR error: {e}")
+            raise
+
+    def extract_coupon_data(self, image_bytes: bytes) -> Dict:
+        return self._extract_one(image_bytes)
 
-            # Parse JSON from response
-            coupon_data = json.loads(content)
+    def _extract_one(self, image_bytes: bytes) -> Dict:
+        # Kept separate from extract_coupon_data so subclasses that override
+        # it (e.g. the batched provider) can still make a direct call
+        payload = self._build_payload(image_bytes)
 
-            # Convert date strings to datetime
-            if coupon_data.get('expiryDate'):
-                coupon_data['expiryDate'] = datetime.fromisoformat(coupon_data['expiryDate'].replace('Z', '+00:00'))
-            if coupon_data.get('deadline'):
-                coupon_data['deadline'] = datetime.fromisoformat(coupon_data['deadline'].replace('Z', '+00:00'))
+        try:
+            response = self._session.post(
+                f"{self.base_url}/chat/completions",
+                headers=self.headers,
+                data=orjson.dumps(payload),
+                timeout=30
+            )
+            response.raise_for_status()
 
-            return coupon_data
+            return self._parse_response(orjson.loads(response.content))
 
         except Exception as e:
             print(f"GPT-4o OCR error: {e}")
             raise
 
 
+class OCRBatcher:
+    """Coalesces concurrent OCR requests into batched GPT-4o calls.
+
+    Requests arriving within ``max_wait`` seconds of each other (up to
+    ``max_batch`` images) are sent as one multi-image prompt, and each
+    caller's future is resolved with its own entry of the result.
+    """
+
+    def __init__(self, max_batch: int = 8, max_wait: float = 0.05):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def submit(self, provider: GPT4oOCR, image_bytes: bytes) -> Future:
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((provider, image_bytes, future))
+        return future
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='ocr-batcher', daemon=True)
+                self._worker.start()
+
+    def _collect(self) -> List:
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return items
+
+    @staticmethod
+    def _settle(future: Future, result: Optional[Dict] = None, error: Optional[Exception] = None):
+        try:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass  # Already resolved, or cancelled by the caller
+
+    def _process_group(self, group: List):
+        provider = group[0][0]
+        try:
+            results = provider.extract_coupon_batch([image for _, image, _ in group])
+        except Exception as e:
+            if len(group) == 1:
+                self._settle(group[0][2], error=e)
+                return
+            # One bad entry must not fail everyone else's scan
+            print(f"GPT-4o batch of {len(group)} unusable, retrying images individually: {e}")
+            results = None
+
+        if results is None:
+            for _, image, future in group:
+                try:
+                    self._settle(future, result=provider._extract_one(image))
+                except Exception as e:
+                    self._settle(future, error=e)
+            return
+
+        for (_, _, future), coupon_data in zip(group, results):
+            self._settle(future, result=coupon_data)
+
+    def _run(self):
+        while True:
+            items = self._collect()
+
+            # Only images sent with the same credentials can share a request
+            groups: Dict[str, List] = {}
+            for item in items:
+                groups.setdefault(item[0].api_key, []).append(item)
+
+            for group in groups.values():
+                try:
+                    self._process_group(group)
+                except Exception as e:
+                    # Every caller must hear back, or its request waits forever
+                    for _, _, future in group:
+                        self._settle(future, error=e)
+
+
+class BatchedGPT4oOCR(GPT4oOCR):
+    """GPT-4o OCR that shares API calls with concurrent requests"""
+
+    _batcher: ClassVar[OCRBatcher] = OCRBatcher()
+
+    def extract_coupon_data(self, image_bytes: bytes) -> Dict:
+        return self._batcher.submit(self, image_bytes).result()
+
+
 class MockOCR(OCRProvider):
     """Mock OCR for testing/demo"""
 
-    def extract_coupon_data(self, image_base64: str) -> Dict:
+    def extract_coupon_data(self, image_bytes: bytes) -> Dict:
         return {
-            'code': f'MOCK{hash(image_base64) % 10000:04d}',
+            'code': f'MOCK{hash(image_bytes) % 10000:04d}',
             'title': 'Mock Coupon from Image',
             'provider': 'TestMerchant',
             'discount': '15% off',
@@ -212,8 +499,10 @@ class OCRFactory:
 
     _providers = {
         'gpt4o': GPT4oOCR,
+        'gpt4o-batched': BatchedGPT4oOCR,
         'mock': MockOCR,
     }
+    _instances: Dict[str, OCRProvider] = {}
 
     @classmethod
     def create_provider(cls, provider_name: str, **kwargs) -> OCRProvider:
@@ -223,10 +512,193 @@ class OCRFactory:
         provider_class = cls._providers[provider_name]
         return provider_class(**kwargs)
 
+    @classmethod
+    def get_provider(cls, provider_name: str, **kwargs) -> OCRProvider:
+        """Return a shared provider instance, creating it on first use"""
+        if provider_name not in cls._instances:
+            cls._instances[provider_name] = cls.create_provider(provider_name, **kwargs)
+        return cls._instances[provider_name]
+
     @classmethod
     def register_provider(cls, name: str, provider_class: type):
         """Register a new OCR provider"""
         cls._providers[name] = provider_class
+        cls._instances.pop(name, None)
+
+
+# Build the providers used by request handlers once per worker
+OCRFactory.get_provider('gpt4o-batched', api_key=os.getenv('OPENAI_API_KEY'))
+OCRFactory.get_provider('mock')
+
+
+def provider_for_setting(provider_name: Optional[str]) -> OCRProvider:
+    """Map a user's ocrProvider setting to the shared provider instance"""
+    if provider_name == 'gpt4o':
+        return OCRFactory.get_provider('gpt4o-batched')
+    return OCRFactory.get_provider('mock')
+
+
+MAX_IMAGE_SIDE = 1024
+
+
+def downscale_image(image_bytes: bytes, max_side: int = MAX_IMAGE_SIDE) -> bytes:
+    """Shrink and re-encode large photos as JPEG before sending them for OCR"""
+    if Image is None:
+        return image_bytes
+
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if max(img.size) <= max_side and img.format == 'JPEG':
+            return image_bytes
+
+        # Re-encoding drops EXIF, so bake the orientation into the pixels first
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=85, optimize=True)
+        return buf.getvalue()
+
+    except Exception as e:
+        print(f"Image downscale skipped: {e}")
+        return image_bytes
+
+
+class ExtractionCache:
+    """Content-addressable cache of OCR results, keyed by image hash"""
+
+    _date_fields = ('expiryDate', 'deadline')
+
+    @staticmethod
+    def make_key(image_bytes: bytes, provider_name: str, model: Optional[str]) -> str:
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"|{provider_name}|{model or ''}".encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def get(cls, key: str) -> Optional[Dict]:
+        entry = db.session.get(OCRCache, key)
+        if not entry:
+            return None
+
+        coupon_data = orjson.loads(entry.json_payload)
+        for field in cls._date_fields:
+            if coupon_data.get(field):
+                coupon_data[field] = ciso8601.parse_datetime(coupon_data[field])
+        return coupon_data
+
+    @classmethod
+    def set(cls, key: str, provider_name: str, model: Optional[str], coupon_data: Dict):
+        payload = {
+            k: v.isoformat() if isinstance(v, datetime) else v
+            for k, v in coupon_data.items()
+        }
+        # Concurrent scans of the same image race to insert the same key;
+        # the results are interchangeable, so the first one wins
+        insert = sqlite_insert if db.engine.dialect.name == 'sqlite' else postgresql_insert
+        db.session.execute(
+            insert(OCRCache)
+            .values(
+                hash=key,
+                provider=provider_name,
+                model=model,
+                json_payload=orjson.dumps(payload).decode(),
+            )
+            .on_conflict_do_nothing(index_elements=['hash'])
+        )
+
+
+# Serialized settings per user id, so bursts of uploads skip the settings query.
+# Invalidated locally on update; other workers may serve stale values for up to the TTL.
+_settings_cache = TTLCache(maxsize=10_000, ttl=60)
+_settings_cache_lock = threading.Lock()
+
+
+def load_settings(user_id: int) -> Optional[Dict]:
+    """Return the user's settings as a dict, or None if they have none yet"""
+    # TTLCache is not thread-safe; request threads share it
+    with _settings_cache_lock:
+        cached = _settings_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    settings = UserSettings.query.filter_by(user_id=user_id).first()
+    if not settings:
+        return None
+
+    cached = settings.to_dict()
+    with _settings_cache_lock:
+        _settings_cache[user_id] = cached
+    return cached
+
+
+# ============= BACKGROUND OCR =============
+
+# OCR runs off the request thread; concurrent jobs also feed the GPT-4o batcher
+_ocr_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='ocr')
+
+# Jobs live only in this process, so a restart orphans their placeholders.
+# Anything still pending after this long is treated as a lost scan.
+PENDING_TIMEOUT = timedelta(minutes=10)
+
+
+def delete_stale_pending(user_id: Optional[int] = None) -> int:
+    """Remove placeholders of scans that never completed"""
+    stmt = db.delete(Coupon).where(
+        Coupon.status == 'pending',
+        Coupon.created_at < datetime.utcnow() - PENDING_TIMEOUT,
+    )
+    if user_id is not None:
+        stmt = stmt.where(Coupon.user_id == user_id)
+
+    deleted = db.session.execute(stmt).rowcount
+    db.session.commit()
+    return deleted
+
+
+def apply_coupon_data(coupon: Coupon, coupon_data: Dict):
+    """Copy extracted OCR fields onto a coupon record"""
+    # The model answers null for unreadable fields; required columns need a value
+    coupon.code = coupon_data.get('code') or 'UNKNOWN'
+    coupon.title = coupon_data.get('title') or 'Coupon'
+    coupon.provider = coupon_data.get('provider', '')
+    coupon.discount = coupon_data.get('discount', '')
+    coupon.terms = coupon_data.get('terms', '')
+    coupon.expiry_date = coupon_data.get('expiryDate') or datetime.utcnow() + timedelta(days=30)
+    coupon.deadline = coupon_data.get('deadline')
+
+
+def process_ocr(coupon_id: int, image_bytes: bytes, provider_name: str, cache_key: str):
+    """Run OCR for a pending coupon and fill in its record"""
+    with app.app_context():
+        ocr_provider = provider_for_setting(provider_name)
+        try:
+            coupon_data = ocr_provider.extract_coupon_data(downscale_image(image_bytes))
+        except Exception as e:
+            # Drop the placeholder rather than leave a fake coupon in the list;
+            # clients polling it get a 404 and report the scan as failed
+            print(f"Error processing coupon {coupon_id}: {e}")
+            coupon = db.session.get(Coupon, coupon_id)
+            if coupon and coupon.status == 'pending':
+                db.session.delete(coupon)
+                db.session.commit()
+            return
+
+        # The cache is best-effort and must not cost the user their coupon
+        try:
+            ExtractionCache.set(cache_key, provider_name, getattr(ocr_provider, 'model', None), coupon_data)
+            db.session.commit()
+        except Exception as e:
+            print(f"Error caching OCR result for coupon {coupon_id}: {e}")
+            db.session.rollback()
+
+        coupon = db.session.get(Coupon, coupon_id)
+        if coupon:
+            apply_coupon_data(coupon, coupon_data)
+            coupon.status = 'ready'
+            db.session.commit()
 
 
 # ============= ROUTES =============
@@ -240,15 +712,10 @@ def login():
 
     user = User.query.filter_by(email=email).first()
     if not user:
-        user = User(email=email, name=name)
+        # Default settings are inserted alongside the user by the relationship cascade
+        user = User(email=email, name=name, settings=UserSettings())
         db.session.add(user)
-        db.session.flush()
-
-        # Create default settings
-        settings = UserSettings(user_id=user.id)
-        db.session.add(settings)
-
-    db.session.commit()
+        db.session.commit()
 
     access_token = create_access_token(identity=user.id)
     return jsonify({
@@ -262,8 +729,24 @@ def login():
 def get_coupons():
     """Get all coupons for authenticated user"""
     user_id = get_jwt_identity()
-    coupons = Coupon.query.filter_by(user_id=user_id).all()
-    return jsonify([coupon.to_dict() for coupon in coupons])
+    delete_stale_pending(user_id)
+
+    # Select plain rows rather than ORM instances; the list is read-only
+    rows = db.session.execute(
+        db.select(*(column for _, column in COUPON_FIELDS))
+        .where(Coupon.user_id == user_id)
+        .execution_options(yield_per=200)
+    )
+
+    def generate():
+        # Stream the array one coupon at a time rather than building it in memory
+        separator = b'['
+        for row in rows:
+            yield separator + orjson.dumps(dict(zip(COUPON_KEYS, row)))
+            separator = b','
+        yield b']' if separator == b',' else b'[]'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 
 @app.route('/api/coupons', methods=['POST'])
@@ -271,7 +754,7 @@ def get_coupons():
 def create_coupon():
     """Create coupon from image (OCR processing)"""
     user_id = get_jwt_identity()
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
 
     if not user:
         return jsonify({'error': 'User not found'}), 404
@@ -288,7 +771,10 @@ def create_coupon():
 
         # Remove data:image/jpeg;base64, prefix if present
         if ',' in image_base64:
-            image_base64 = image_base64.split(',')[1]
+            image_base64 = image_base64.split(',', 1)[1]
+
+        # Decode once; providers and the OCR cache work on the raw bytes
+        image_bytes = base64.b64decode(image_base64, validate=False)
 
     except Exception as e:
         print(f"Error parsing request: {e}")
@@ -296,40 +782,55 @@ def create_coupon():
 
     try:
         # Get user's OCR provider settings
-        settings = user.settings or UserSettings(user_id=user_id)
-        provider_name = settings.ocr_provider
+        settings = load_settings(user_id) or UserSettings(user_id=user_id).to_dict()
+        provider_name = settings['ocrProvider']
 
         # Initialize OCR provider
-        if provider_name == 'gpt4o':
-            ocr_provider = OCRFactory.create_provider('gpt4o', api_key=os.getenv('OPENAI_API_KEY'))
+        ocr_provider = provider_for_setting(provider_name)
+
+        # Reuse a previous result for identical images
+        model = getattr(ocr_provider, 'model', None)
+        cache_key = ExtractionCache.make_key(image_bytes, provider_name, model)
+        coupon_data = ExtractionCache.get(cache_key)
+
+        coupon = Coupon(user_id=user_id)
+        if coupon_data is not None:
+            apply_coupon_data(coupon, coupon_data)
         else:
-            ocr_provider = OCRFactory.create_provider('mock')
-
-        # Extract coupon data
-        coupon_data = ocr_provider.extract_coupon_data(image_base64)
-
-        # Create coupon record
-        coupon = Coupon(
-            user_id=user_id,
-            code=coupon_data.get('code', 'UNKNOWN'),
-            title=coupon_data.get('title', 'Coupon'),
-            provider=coupon_data.get('provider', ''),
-            discount=coupon_data.get('discount', ''),
-            terms=coupon_data.get('terms', ''),
-            expiry_date=coupon_data.get('expiryDate', datetime.utcnow() + timedelta(days=30)),
-            deadline=coupon_data.get('deadline'),
-        )
+            # Placeholder until the background OCR job fills in the details
+            coupon.code = ''
+            coupon.title = 'Scanning coupon'
+            coupon.expiry_date = datetime.utcnow() + timedelta(days=30)
+            coupon.status = 'pending'
 
         db.session.add(coupon)
         db.session.commit()
 
-        return jsonify(coupon.to_dict()), 201
+        if coupon.status != 'pending':
+            return jsonify(coupon.to_dict()), 201
+
+        _ocr_executor.submit(process_ocr, coupon.id, image_bytes, provider_name, cache_key)
+        return jsonify(coupon.to_dict()), 202
 
     except Exception as e:
         print(f"Error processing coupon: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/coupons/<int:coupon_id>', methods=['GET'])
+@jwt_required()
+def get_coupon(coupon_id):
+    """Get a single coupon, e.g. to poll a pending scan"""
+    user_id = get_jwt_identity()
+    delete_stale_pending(user_id)
+    coupon = Coupon.query.filter_by(id=coupon_id, user_id=user_id).first()
+
+    if not coupon:
+        return jsonify({'error': 'Coupon not found'}), 404
+
+    return jsonify(coupon.to_dict())
+
+
 @app.route('/api/coupons/<int:coupon_id>', methods=['PATCH'])
 @jwt_required()
 def update_coupon(coupon_id):
@@ -368,14 +869,15 @@ def delete_coupon(coupon_id):
 def get_settings():
     """Get user settings"""
     user_id = get_jwt_identity()
-    settings = UserSettings.query.filter_by(user_id=user_id).first()
+    settings = load_settings(user_id)
 
-    if not settings:
-        settings = UserSettings(user_id=user_id)
-        db.session.add(settings)
+    if settings is None:
+        user_settings = UserSettings(user_id=user_id)
+        db.session.add(user_settings)
         db.session.commit()
+        settings = user_settings.to_dict()
 
-    return jsonify(settings.to_dict())
+    return jsonify(settings)
 
 
 @app.route('/api/settings', methods=['POST'])
@@ -402,6 +904,8 @@ def update_settings():
         settings.ocr_provider = data['ocrProvider']
 
     db.session.commit()
+    with _settings_cache_lock:
+        _settings_cache.pop(user_id, None)
     return jsonify(settings.to_dict())
 
 
@@ -435,6 +939,19 @@ def init_db():
     """Initialize database"""
     with app.app_context():
         db.create_all()
+
+        # create_all skips tables that already exist, so add any indexes
+        # declared since the database was first created
+        for index in Coupon.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+        # Likewise for columns added to existing tables
+        coupon_columns = {c['name'] for c in sa_inspect(db.engine).get_columns('coupon')}
+        if 'status' not in coupon_columns:
+            with db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE coupon ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'ready'"))
+
+        delete_stale_pending()
         print("Database initialized")
 
 
@@ -0,0 +1,301 @@
+import base64
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+# Point the app at a throwaway database before it is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import backend  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, content: str):
+        self.content = orjson.dumps({"choices": [{"message": {"content": content}}]})
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def app_context():
+    """Fresh tables for each test"""
+    with backend.app.app_context():
+        backend.db.drop_all()
+        backend.db.create_all()
+        backend._settings_cache.clear()
+        yield
+        backend.db.session.remove()
+
+
+class DeferredExecutor:
+    """Stands in for the OCR thread pool; jobs run when the test says so"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run_all(self):
+        jobs, self.jobs = self.jobs, []
+        for fn, args in jobs:
+            fn(*args)
+
+
+@pytest.fixture
+def ocr_jobs(monkeypatch):
+    executor = DeferredExecutor()
+    monkeypatch.setattr(backend, '_ocr_executor', executor)
+    return executor
+
+
+@pytest.fixture
+def client(app_context):
+    return backend.app.test_client()
+
+
+@pytest.fixture
+def auth_headers(client):
+    """Logged-in user whose scans use the mock OCR provider"""
+    token = client.post('/api/auth/login', json={'email': 'user@example.com'}).get_json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/api/settings', json={'ocrProvider': 'mock'}, headers=headers)
+    return headers
+
+
+def upload(client, headers, image: bytes):
+    return client.post('/api/coupons', json={'image': base64.b64encode(image).decode()}, headers=headers)
+
+
+@pytest.fixture
+def openai_calls(monkeypatch):
+    """Stub the shared GPT-4o session; records the image count of each call"""
+    calls = []
+    lock = threading.Lock()
+
+    def post(url, headers=None, data=None, timeout=None):
+        content = orjson.loads(data)['messages'][0]['content']
+        count = sum(1 for block in content if block['type'] == 'image_url')
+        with lock:
+            calls.append(count)
+
+        coupon = {"code": "SAVE10", "title": "Coupon", "expiryDate": "2026-12-01T00:00:00Z"}
+        if count == 1:
+            return FakeResponse(orjson.dumps(coupon).decode())
+        return FakeResponse(orjson.dumps({"coupons": [coupon] * count}).decode())
+
+    monkeypatch.setattr(backend.GPT4oOCR._session, 'post', post)
+    return calls
+
+
+def test_batcher_single_image(openai_calls):
+    batcher = backend.OCRBatcher()
+    provider = backend.BatchedGPT4oOCR(api_key='key')
+
+    coupon_data = batcher.submit(provider, b'image').result(timeout=5)
+
+    assert coupon_data['code'] == 'SAVE10'
+    assert coupon_data['expiryDate'].year == 2026
+    assert openai_calls == [1]
+
+
+def test_batcher_concurrent_images(openai_calls):
+    batcher = backend.OCRBatcher(max_batch=8, max_wait=0.5)
+    provider = backend.BatchedGPT4oOCR(api_key='key')
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        futures = list(pool.map(lambda i: batcher.submit(provider, bytes([i])), range(5)))
+    results = [future.result(timeout=5) for future in futures]
+
+    assert [coupon_data['code'] for coupon_data in results] == ['SAVE10'] * 5
+    assert sum(openai_calls) == 5
+    assert len(openai_calls) < 5
+
+
+def test_batcher_resolves_futures_when_batch_fails(monkeypatch):
+    def post(*args, **kwargs):
+        raise ConnectionError('unreachable')
+
+    monkeypatch.setattr(backend.GPT4oOCR._session, 'post', post)
+    batcher = backend.OCRBatcher(max_wait=0.2)
+    provider = backend.BatchedGPT4oOCR(api_key='key')
+
+    futures = [batcher.submit(provider, bytes([i])) for i in range(3)]
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=5)
+
+
+def test_batcher_retries_images_individually_when_batch_is_unusable(monkeypatch):
+    calls = []
+
+    def post(url, headers=None, data=None, timeout=None):
+        content = orjson.loads(data)['messages'][0]['content']
+        images = [
+            base64.b64decode(block['image_url']['url'].split(',', 1)[1])
+            for block in content if block['type'] == 'image_url'
+        ]
+        calls.append(len(images))
+
+        if len(images) > 1:
+            # One null entry makes the whole batch reply unusable
+            coupons = [None if image == b'bad' else {"code": "BATCH"} for image in images]
+            return FakeResponse(orjson.dumps({"coupons": coupons}).decode())
+        if images[0] == b'bad':
+            return FakeResponse('no coupon here')
+        return FakeResponse(orjson.dumps({"code": images[0].decode().upper()}).decode())
+
+    monkeypatch.setattr(backend.GPT4oOCR._session, 'post', post)
+    batcher = backend.OCRBatcher(max_wait=0.5)
+    provider = backend.BatchedGPT4oOCR(api_key='key')
+
+    futures = [batcher.submit(provider, image) for image in (b'one', b'bad', b'two')]
+
+    assert futures[0].result(timeout=5)['code'] == 'ONE'
+    assert futures[2].result(timeout=5)['code'] == 'TWO'
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    assert calls == [3, 1, 1, 1]
+
+
+def test_downscale_image_applies_exif_orientation():
+    Image = pytest.importorskip('PIL.Image')
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW to display
+    buf = io.BytesIO()
+    Image.new('RGB', (3000, 2000)).save(buf, 'JPEG', exif=exif)
+
+    out = Image.open(io.BytesIO(backend.downscale_image(buf.getvalue())))
+
+    assert out.size == (683, 1024)
+    assert out.getexif().get(0x0112) in (None, 1)
+
+
+def test_extraction_cache_key_separates_providers_and_models():
+    key = backend.ExtractionCache.make_key(b'image', 'gpt4o', 'gpt-4o')
+
+    assert key == backend.ExtractionCache.make_key(b'image', 'gpt4o', 'gpt-4o')
+    assert key != backend.ExtractionCache.make_key(b'other', 'gpt4o', 'gpt-4o')
+    assert key != backend.ExtractionCache.make_key(b'image', 'mock', None)
+    assert key != backend.ExtractionCache.make_key(b'image', 'gpt4o', 'gpt-4o-mini')
+
+
+def test_extraction_cache_miss_then_hit_round_trips_dates(app_context):
+    key = backend.ExtractionCache.make_key(b'image', 'gpt4o', 'gpt-4o')
+    coupon_data = {
+        'code': 'SAVE10',
+        'expiryDate': datetime(2026, 12, 1, tzinfo=timezone.utc),
+        'deadline': datetime(2026, 11, 20, 8, 30),
+        'terms': None,
+    }
+
+    assert backend.ExtractionCache.get(key) is None
+
+    backend.ExtractionCache.set(key, 'gpt4o', 'gpt-4o', coupon_data)
+    backend.db.session.commit()
+
+    assert backend.ExtractionCache.get(key) == coupon_data
+
+
+def test_extraction_cache_set_ignores_duplicate_keys(app_context):
+    key = backend.ExtractionCache.make_key(b'image', 'mock', None)
+
+    backend.ExtractionCache.set(key, 'mock', None, {'code': 'FIRST'})
+    backend.db.session.commit()
+    backend.ExtractionCache.set(key, 'mock', None, {'code': 'SECOND'})
+    backend.db.session.commit()
+
+    assert backend.ExtractionCache.get(key) == {'code': 'FIRST'}
+
+
+def test_duplicate_uploads_in_flight_both_complete(client, auth_headers, ocr_jobs):
+    first = upload(client, auth_headers, b'same image')
+    second = upload(client, auth_headers, b'same image')
+    assert first.status_code == second.status_code == 202
+
+    ocr_jobs.run_all()
+
+    for response in (first, second):
+        coupon = client.get(f"/api/coupons/{response.get_json()['id']}", headers=auth_headers)
+        assert coupon.status_code == 200
+        assert coupon.get_json()['status'] == 'ready'
+
+
+def test_cache_write_failure_keeps_the_scanned_coupon(client, auth_headers, ocr_jobs, monkeypatch):
+    def broken_set(*args, **kwargs):
+        raise RuntimeError('cache unavailable')
+
+    monkeypatch.setattr(backend.ExtractionCache, 'set', broken_set)
+    coupon_id = upload(client, auth_headers, b'image').get_json()['id']
+
+    ocr_jobs.run_all()
+
+    coupon = client.get(f'/api/coupons/{coupon_id}', headers=auth_headers).get_json()
+    assert coupon['status'] == 'ready'
+    assert coupon['code'].startswith('MOCK')
+
+
+def test_stale_pending_placeholders_are_removed(client, auth_headers, ocr_jobs):
+    stale_id = upload(client, auth_headers, b'lost in a restart').get_json()['id']
+    fresh_id = upload(client, auth_headers, b'still scanning').get_json()['id']
+
+    stale = backend.db.session.get(backend.Coupon, stale_id)
+    stale.created_at = datetime.utcnow() - backend.PENDING_TIMEOUT - timedelta(minutes=1)
+    backend.db.session.commit()
+
+    coupons = client.get('/api/coupons', headers=auth_headers).get_json()
+
+    assert [coupon['id'] for coupon in coupons] == [fresh_id]
+    assert client.get(f'/api/coupons/{stale_id}', headers=auth_headers).status_code == 404
+
+
+def test_upload_returns_202_and_poll_shows_result(client, auth_headers, ocr_jobs):
+    response = upload(client, auth_headers, b'image')
+
+    assert response.status_code == 202
+    coupon_id = response.get_json()['id']
+    assert response.get_json()['status'] == 'pending'
+
+    polled = client.get(f'/api/coupons/{coupon_id}', headers=auth_headers).get_json()
+    assert polled['status'] == 'pending'
+
+    ocr_jobs.run_all()
+
+    polled = client.get(f'/api/coupons/{coupon_id}', headers=auth_headers).get_json()
+    assert polled['status'] == 'ready'
+    assert polled['code'].startswith('MOCK')
+    assert polled['provider'] == 'TestMerchant'
+
+
+def test_failed_scan_removes_placeholder(client, auth_headers, ocr_jobs, monkeypatch):
+    def broken_ocr(self, image_bytes):
+        raise RuntimeError('unreadable')
+
+    monkeypatch.setattr(backend.MockOCR, 'extract_coupon_data', broken_ocr)
+    coupon_id = upload(client, auth_headers, b'image').get_json()['id']
+
+    ocr_jobs.run_all()
+
+    assert client.get(f'/api/coupons/{coupon_id}', headers=auth_headers).status_code == 404
+    assert client.get('/api/coupons', headers=auth_headers).get_json() == []
+
+
+def test_repeat_upload_is_served_from_cache_with_201(client, auth_headers, ocr_jobs):
+    upload(client, auth_headers, b'image')
+    ocr_jobs.run_all()
+
+    response = upload(client, auth_headers, b'image')
+
+    assert response.status_code == 201
+    assert response.get_json()['status'] == 'ready'
+    assert ocr_jobs.jobs == []
+    assert len(client.get('/api/coupons', headers=auth_headers).get_json()) == 2